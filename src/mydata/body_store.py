@@ -0,0 +1,202 @@
+"""
+Content-addressed storage of message bodies.
+
+Newsletters and notifications are very repetitive, so the decoded text and links
+of messages are kept apart from their metadata. Every distinct body is stored once
+under the SHA-256 of its contents, and bodies are compressed together in small blocks
+with a preset dictionary trained on the first bodies stored.
+"""
+
+import collections
+import hashlib
+import io
+import json
+import re
+import zlib
+from pathlib import Path
+
+# Deflate refers back at most 32 KB, so only blocks within this size benefit from the whole
+# dictionary. Small blocks also keep reading a single body cheap.
+BLOCK_SIZE = 32 * 1024
+DICTIONARY_SIZE = 32 * 1024
+TRAINING_SIZE = 1024 * 1024  # bodies collected before training the dictionary
+
+# Serialized bodies are JSON, so the text lines are separated by escaped newlines
+PATTERN_SPLIT_SAMPLE = re.compile(rb"(?<=\\n)|(?<=\}, )")
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    Builds a preset compression dictionary from serialized bodies.
+    Fragments repeated across samples (footers, signatures, tracking links) are included,
+    the most frequent ones at the end, where references to the dictionary are the cheapest.
+    """
+    fragment_counts = collections.Counter()
+    for sample in samples:
+        fragment_counts.update(set(PATTERN_SPLIT_SAMPLE.split(sample)))
+
+    fragments = []
+    total_size = 0
+    for fragment, count in fragment_counts.most_common():
+        if count < 2:
+            break
+        if total_size + len(fragment) > size:
+            continue
+        fragments.append(fragment)
+        total_size += len(fragment)
+
+    return b"".join(reversed(fragments))
+
+
+def serialize_body(body):
+    return json.dumps(body, ensure_ascii=False, sort_keys=True).encode("utf-8")
+
+
+def body_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class BodyStore:
+    """
+    Deduplicated and block-compressed storage of message bodies.
+
+    Example:
+    >>> with BodyStore("cache/bodies") as store:
+    ...     key = store.put({"text": "Hello", "links": []})
+    >>> BodyStore("cache/bodies").get(key)
+    {'links': [], 'text': 'Hello'}
+
+    The store keeps in `path`:
+    - `blocks.bin`: compressed blocks, one after another
+    - `dictionary.bin`: preset dictionary shared by all blocks
+    - `index.json`: positions of the blocks in `blocks.bin` and of the bodies in the blocks
+
+    Without `path` the store is kept in memory.
+    """
+
+    def __init__(self, path=None, block_size=BLOCK_SIZE, cache_blocks=64):
+        self.path = Path(path) if path is not None else None
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+
+        self.dictionary = None
+        self.blocks = []  # (offset, size) of compressed blocks
+        self.bodies = {}  # key -> (block index, begin, end) in decompressed block
+        self.pending = {}  # key -> serialized body, not compressed yet
+        self.pending_size = 0
+        self.block_cache = collections.OrderedDict()
+
+        if self.path is None:
+            self.blocks_file = io.BytesIO()
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.blocks_file = open(self.path / "blocks.bin", "a+b")
+            self.load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.bodies) + len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.bodies or key in self.pending
+
+    def load_index(self):
+        dictionary_file = self.path / "dictionary.bin"
+        if dictionary_file.exists():
+            self.dictionary = dictionary_file.read_bytes()
+
+        index_file = self.path / "index.json"
+        if index_file.exists():
+            with open(index_file, "r") as fin:
+                index = json.load(fin)
+            self.blocks = [tuple(block) for block in index["blocks"]]
+            self.bodies = {key: tuple(pos) for key, pos in index["bodies"].items()}
+
+    def save(self):
+        self.flush()
+        self.blocks_file.flush()
+        if self.path is None:
+            return
+        if self.dictionary is not None:
+            (self.path / "dictionary.bin").write_bytes(self.dictionary)
+        with open(self.path / "index.json", "w") as fout:
+            json.dump({"blocks": self.blocks, "bodies": self.bodies}, fout)
+
+    def close(self):
+        self.save()
+        self.blocks_file.close()
+
+    def put(self, body):
+        """Stores the body (JSON-serializable, e.g. dict with `text` and `links`) and returns its key."""
+        data = serialize_body(body)
+        key = body_key(data)
+        if key not in self:
+            self.pending[key] = data
+            self.pending_size += len(data)
+            if self.dictionary is None:
+                flush_size = TRAINING_SIZE
+            else:
+                flush_size = self.block_size
+            if self.pending_size >= flush_size:
+                self.flush()
+        return key
+
+    def get(self, key):
+        """Returns the body stored under the key, decompressing its block if needed."""
+        if key in self.pending:
+            return json.loads(self.pending[key])
+        block_idx, begin, end = self.bodies[key]
+        block = self.read_block(block_idx)
+        return json.loads(block[begin:end])
+
+    def flush(self):
+        """Compresses pending bodies into new blocks of at most `block_size` (unless a body is larger)."""
+        if not self.pending:
+            return
+
+        if self.dictionary is None:
+            self.dictionary = train_dictionary(self.pending.values())
+
+        block = bytearray()
+        for key, data in self.pending.items():
+            if block and len(block) + len(data) > self.block_size:
+                self.write_block(block)
+                block = bytearray()
+            self.bodies[key] = (len(self.blocks), len(block), len(block) + len(data))
+            block += data
+        self.write_block(block)
+
+        self.pending = {}
+        self.pending_size = 0
+
+    def write_block(self, block):
+        compressor = zlib.compressobj(9, **self._zdict())
+        compressed = compressor.compress(block) + compressor.flush()
+
+        self.blocks_file.seek(0, io.SEEK_END)
+        self.blocks.append((self.blocks_file.tell(), len(compressed)))
+        self.blocks_file.write(compressed)
+
+    def read_block(self, block_idx):
+        if block_idx in self.block_cache:
+            self.block_cache.move_to_end(block_idx)
+            return self.block_cache[block_idx]
+
+        offset, size = self.blocks[block_idx]
+        self.blocks_file.seek(offset)
+        decompressor = zlib.decompressobj(**self._zdict())
+        block = decompressor.decompress(self.blocks_file.read(size))
+
+        self.block_cache[block_idx] = block
+        if len(self.block_cache) > self.cache_blocks:
+            self.block_cache.popitem(last=False)
+        return block
+
+    def _zdict(self):
+        # zlib rejects empty dictionaries
+        return {"zdict": self.dictionary} if self.dictionary else {}
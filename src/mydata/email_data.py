@@ -267,6 +267,7 @@ class MboxChunk:
         self.begin = begin
         self.end = end
         self.positions = []
+        self.stops = []
         self.init_positions()
 
     def __del__(self):
@@ -274,25 +275,39 @@ class MboxChunk:
 
     def init_positions(self):
         self.positions = []
-        self.file_obj.seek(self.begin)
+        self.stops = []
+        separator = b""
+        if self.begin > 0:
+            # Align to the start of the line, so that "From " in the middle of a line is not matched
+            self.file_obj.seek(self.begin - 1)
+            self.file_obj.readline()
+        else:
+            self.file_obj.seek(0)
         while True:
             line = self.file_obj.readline()
             if line.startswith(b"From ") or not line:
                 start_pos = self.file_obj.tell() - len(line)
+                if self.positions:
+                    # The empty line before "From " separates messages, like in mailbox.mbox
+                    self.stops.append(start_pos - len(separator))
                 self.positions.append(start_pos)
                 if (self.end is not None and start_pos >= self.end) or not line:
                     break
+            separator = line if line in (b"\n", b"\r\n") else b""
 
     def __len__(self):
         return len(self.positions) - 1
 
-    def __getitem__(self, item):
+    def get_bytes(self, item):
+        """Raw message data, including the "From " line."""
         if item < 0 or item >= len(self):
             raise IndexError("index out of range")
-        start_pos, end_pos = self.positions[item], self.positions[item + 1]
+        start_pos, end_pos = self.positions[item], self.stops[item]
         self.file_obj.seek(start_pos)
-        msg_data = self.file_obj.read(end_pos - start_pos)
-        return email.message_from_bytes(msg_data)
+        return self.file_obj.read(end_pos - start_pos)
+
+    def __getitem__(self, item):
+        return email.message_from_bytes(self.get_bytes(item))
 
     def __iter__(self):
         for i in range(len(self)):
@@ -311,3 +326,99 @@ def mbox_chunks(filename, chunk_size=100 * 1024 * 1024):
     for begin in range(0, file_size, chunk_size):
         end = min(begin + chunk_size, file_size)
         yield MboxChunk(filename, begin, end)
+
+
+class MboxIndexEntry(NamedTuple):
+    """Position of a message in mbox file with the headers needed to select it without parsing."""
+
+    begin: int
+    end: int
+    unixtime: float | None
+    message_id: str | None
+    thread_id: str | None
+
+
+def _index_entry(begin, end, headers):
+    unixtime = None
+    message_id = None
+    thread_id = None
+    if b"date" in headers:
+        date = " ".join(headers[b"date"].decode("ascii", errors="ignore").split())
+        try:
+            unixtime = time.mktime(
+                email.utils.parsedate_to_datetime(date).utctimetuple()
+            )
+        except (TypeError, ValueError, OverflowError):
+            pass
+    if b"message-id" in headers:
+        message_id = headers[b"message-id"].decode("ascii", errors="ignore").strip()
+    if b"x-gm-thrid" in headers:
+        thread_id = headers[b"x-gm-thrid"].decode("ascii", errors="ignore").strip()
+    return MboxIndexEntry(begin, end, unixtime, message_id or None, thread_id or None)
+
+
+def index_mbox(filename, begin=0, end=None):
+    """
+    Lists messages of mbox file with their byte ranges, dates, Message-IDs and Gmail thread IDs.
+    Only headers are looked at, message bodies are skipped without decoding.
+    As in `mailbox.mbox`, the ranges do not include the empty lines separating messages.
+    Dates are converted to unixtime the same way as in `Message.unixtime`.
+
+    With `begin` and `end` only the messages starting in [begin, end) are listed
+    (like in `MboxChunk`), so that parts of a large file can be indexed in parallel.
+    """
+    indexed_headers = {b"date", b"message-id", b"x-gm-thrid"}
+    entries = []
+    msg_begin = None
+    headers = {}
+    header_name = None
+    in_headers = False
+    separator = b""
+    with open(filename, "rb") as file_obj:
+        if begin > 0:
+            # Align to the start of the line, so that "From " in the middle of a line is not matched
+            file_obj.seek(begin - 1)
+            file_obj.readline()
+        pos = file_obj.tell()
+        for line in file_obj:
+            if line.startswith(b"From "):
+                if msg_begin is not None:
+                    msg_end = pos - len(separator)
+                    entries.append(_index_entry(msg_begin, msg_end, headers))
+                    msg_begin = None
+                if end is not None and pos >= end:
+                    break
+                msg_begin = pos
+                headers = {}
+                header_name = None
+                in_headers = True
+            elif in_headers:
+                if not line.strip():
+                    in_headers = False
+                elif line[:1] in (b" ", b"\t"):
+                    # Folded header continues on this line
+                    if header_name is not None:
+                        headers[header_name] += line
+                else:
+                    name, _, value = line.partition(b":")
+                    name = name.strip().lower()
+                    header_name = None
+                    if name in indexed_headers and name not in headers:
+                        header_name = name
+                        headers[name] = value
+            separator = line if line in (b"\n", b"\r\n") else b""
+            pos += len(line)
+
+    if msg_begin is not None:
+        entries.append(_index_entry(msg_begin, pos - len(separator), headers))
+    return entries
+
+
+def read_mbox_messages(filename, entries):
+    """
+    Reads raw messages from mbox file at the byte ranges of the index entries.
+    """
+    with open(filename, "rb") as file_obj:
+        for entry in entries:
+            file_obj.seek(entry.begin)
+            yield file_obj.read(entry.end - entry.begin)
@@ -7,25 +7,42 @@ PYTHONIOENCODING=utf-8 python mailbox_analyzer.py
 """
 
 import collections
+import datetime
+import hashlib
 import io
 import json
-import mailbox
 import re
 import sys
+import time
 import warnings
 import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import NamedTuple
 
 import pandas
 import requests
 import tldextract
 from bs4 import BeautifulSoup
+from dateutil.parser import parse as parse_date
 from tqdm import tqdm
 
-from .email_data import Message
+from .body_store import BodyStore
+from .email_data import (
+    MboxChunk,
+    MboxIndexEntry,
+    Message,
+    index_mbox,
+    read_mbox_messages,
+)
 
 warnings.filterwarnings("ignore", category=UserWarning, module="bs4")
 
+CHUNK_SIZE = 64 * 1024 * 1024
+# Increase to rebuild the cached indexes after changes in `index_mbox`
+MBOX_INDEX_VERSION = 2
+
 
 def parse_mbox_message(mbox_msg):
     msg = Message(mbox_msg)
@@ -105,6 +122,21 @@ def parse_mbox_message(mbox_msg):
     }
 
 
+def get_message_body(message, body_store=None):
+    """
+    Returns `text` and `links` of a parsed message.
+    The body is read from the store if the message keeps only a reference to it,
+    e.g. messages from `cache/email.json` need `BodyStore("cache/bodies")`.
+    """
+    if "body" in message:
+        if body_store is None:
+            raise ValueError(
+                "Message keeps only a reference to its body, body_store is required"
+            )
+        return body_store.get(message["body"])
+    return {"text": message["text"], "links": message["links"]}
+
+
 def label_threads(messages):
     """
     Assigns to each message `first_id`, the pointer to the first known message in the thread.
@@ -322,41 +354,331 @@ def detect_accounts(threads, my_addrs, domain_rank=None):
     return accounts
 
 
-def parse_mbox(exports_dir="exports"):
-    n_failed_to_parse = 0
-    messages = {}
+def _mbox_index_json(mbox_file, index_dir):
+    file_key = hashlib.sha1(str(Path(mbox_file).resolve()).encode()).hexdigest()
+    return Path(index_dir) / f"{file_key}.json"
+
+
+def read_cached_mbox_index(mbox_file, index_dir=None):
+    """
+    Returns the index of mbox file cached in `index_dir`,
+    or None if there is none or the file size or mtime has changed since.
+    """
+    if index_dir is None:
+        return None
+
+    index_json = _mbox_index_json(mbox_file, index_dir)
+    if not index_json.exists():
+        return None
+
+    stat = Path(mbox_file).stat()
+    with open(index_json, "r") as fin:
+        index = json.load(fin)
+    if (
+        index.get("version") == MBOX_INDEX_VERSION
+        and index["size"] == stat.st_size
+        and index["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return [MboxIndexEntry(*entry) for entry in index["entries"]]
+
 
-    mbox_files = list(Path(exports_dir).glob("**/*.mbox"))
-    for mbox_file_idx, mbox_file in enumerate(mbox_files):
-        mbox = mailbox.mbox(mbox_file)
+def save_mbox_index(mbox_file, entries, index_dir=None):
+    """Caches the index of mbox file in `index_dir`, if given."""
+    if index_dir is None:
+        return
+
+    stat = Path(mbox_file).stat()
+    Path(index_dir).mkdir(parents=True, exist_ok=True)
+    with open(_mbox_index_json(mbox_file, index_dir), "w") as fout:
+        json.dump(
+            {
+                "version": MBOX_INDEX_VERSION,
+                "file": str(mbox_file),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "entries": entries,
+            },
+            fout,
+        )
+
+
+def load_mbox_index(mbox_file, index_dir=None):
+    """
+    Returns the index of mbox file (see `index_mbox`).
+    If `index_dir` is given, the index is cached there until the file size or mtime changes.
+    """
+    entries = read_cached_mbox_index(mbox_file, index_dir)
+    if entries is None:
+        entries = index_mbox(mbox_file)
+        save_mbox_index(mbox_file, entries, index_dir)
+    return entries
+
+
+def _to_unixtime(value):
+    if isinstance(value, str):
+        value = parse_date(value)
+    if isinstance(value, datetime.datetime):
+        return time.mktime(value.utctimetuple())
+    if isinstance(value, datetime.date):
+        return time.mktime(value.timetuple())
+    return value
 
-        mbox_size = len(mbox)
 
-        desc = f"[{mbox_file_idx + 1}/{len(mbox_files)}] {mbox_file.relative_to(exports_dir)}"
-        for msg_index, mbox_msg in tqdm(enumerate(mbox), total=mbox_size, desc=desc):
-            try:
-                message = parse_mbox_message(mbox_msg)
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception:
-                n_failed_to_parse += 1
+def select_mbox_entries(entries, since=None, until=None, sample_rate=None):
+    """
+    Selects index entries of messages sent in [since, until) (datetime, date, date string or unixtime),
+    and then a `sample_rate` fraction of them. Messages without Date are skipped if the window is set.
+
+    Sampling is decided by the thread ID (X-GM-THRID) or, if there is none, by Message-ID.
+    So the messages of a thread, as well as copies of a message in different mbox files,
+    are either all selected or all skipped.
+    """
+    since = _to_unixtime(since)
+    until = _to_unixtime(until)
+
+    selected = []
+    for entry in entries:
+        if since is not None or until is not None:
+            if entry.unixtime is None:
+                continue
+            if since is not None and entry.unixtime < since:
                 continue
+            if until is not None and entry.unixtime >= until:
+                continue
+        if sample_rate is not None:
+            sample_key = entry.thread_id or entry.message_id or str(entry.begin)
+            if zlib.crc32(sample_key.encode()) / 2**32 >= sample_rate:
+                continue
+        selected.append(entry)
+    return selected
+
+
+class MboxTask(NamedTuple):
+    """Part of mbox file parsed by one worker."""
 
-            message_id = message["message_id"]
-            if message_id is not None:
-                if message_id in messages:
+    mbox_file: Path
+    begin: int
+    end: int
+    # Selected messages, or None to parse all messages starting in [begin, end)
+    entries: list | None = None
+
+    @property
+    def size(self):
+        if self.entries is None:
+            return self.end - self.begin
+        return sum(entry.end - entry.begin for entry in self.entries)
+
+
+def plan_mbox_tasks(mbox_entries, chunk_size=CHUNK_SIZE):
+    """
+    Splits mbox files into tasks of about `chunk_size` bytes and orders them largest first,
+    so that a huge file is split across all workers and the small files fill in the gaps.
+
+    `mbox_entries` maps mbox file to the list of selected index entries,
+    or to None if the whole file is parsed.
+    """
+    tasks = []
+    for mbox_file, entries in mbox_entries.items():
+        if entries is None:
+            file_size = Path(mbox_file).stat().st_size
+            for begin in range(0, file_size, chunk_size):
+                end = min(begin + chunk_size, file_size)
+                tasks.append(MboxTask(mbox_file, begin, end))
+            continue
+
+        group = []
+        group_size = 0
+        for entry in entries:
+            if group and group_size + entry.end - entry.begin > chunk_size:
+                tasks.append(MboxTask(mbox_file, group[0].begin, group[-1].end, group))
+                group = []
+                group_size = 0
+            group.append(entry)
+            group_size += entry.end - entry.begin
+        if group:
+            tasks.append(MboxTask(mbox_file, group[0].begin, group[-1].end, group))
+
+    file_sizes = collections.Counter()
+    for task in tasks:
+        file_sizes[task.mbox_file] += task.size
+    tasks.sort(key=lambda task: (task.size, file_sizes[task.mbox_file]), reverse=True)
+    return tasks
+
+
+def index_mbox_task(task):
+    """Indexes messages starting in the byte range of the task. Runs in a worker process."""
+    return index_mbox(task.mbox_file, task.begin, task.end)
+
+
+def parse_mbox_task(task):
+    """
+    Parses messages of the task. Runs in a worker process.
+    Returns the parsed messages with their offsets in the file,
+    and the number of messages failed to parse.
+    """
+    if task.entries is None:
+        chunk = MboxChunk(task.mbox_file, task.begin, task.end)
+        offsets = chunk.positions[:-1]
+        mbox_msgs = (chunk.get_bytes(i) for i in range(len(chunk)))
+    else:
+        offsets = [entry.begin for entry in task.entries]
+        mbox_msgs = read_mbox_messages(task.mbox_file, task.entries)
+
+    parsed_messages = []
+    n_failed_to_parse = 0
+    for offset, mbox_msg in zip(offsets, mbox_msgs):
+        try:
+            parsed_messages.append((offset, parse_mbox_message(mbox_msg)))
+        except Exception:
+            n_failed_to_parse += 1
+    return parsed_messages, n_failed_to_parse
+
+
+def run_tasks(func, tasks, n_workers=None):
+    """
+    Runs `func` on the tasks in a process pool of `n_workers` (all CPUs by default),
+    starting them in the given order. Yields `(task, result)` as the tasks complete.
+    """
+    if n_workers == 1:
+        for task in tasks:
+            yield task, func(task)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        futures = {executor.submit(func, task): task for task in tasks}
+        for future in as_completed(futures):
+            # Drop the finished future, so that its result is not kept until the end
+            yield futures.pop(future), future.result()
+    except KeyboardInterrupt:
+        sys.exit()
+    finally:
+        # Also stops the workers on errors and when the caller stops iterating early
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _files_progress(done_bytes, total_bytes, exports_dir):
+    n_finished = sum(done_bytes[f] >= total_bytes[f] for f in total_bytes)
+    started = [
+        f"{mbox_file.relative_to(exports_dir)} {done_bytes[mbox_file] / total_bytes[mbox_file]:.0%}"
+        for mbox_file in total_bytes
+        if 0 < done_bytes[mbox_file] < total_bytes[mbox_file]
+    ]
+    return ", ".join([f"files {n_finished}/{len(total_bytes)}"] + started)
+
+
+def parse_mbox(
+    exports_dir="exports",
+    body_store=None,
+    since=None,
+    until=None,
+    sample_rate=None,
+    index_dir=None,
+    n_workers=None,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Parses all .mbox files in `exports_dir`.
+    If `body_store` is given, `text` and `links` of the messages are moved there
+    and the messages keep only the `body` key.
+
+    With `since`, `until` or `sample_rate` only the selected messages are read and parsed,
+    see `select_mbox_entries`. The messages are found with a header-only scan of the files,
+    which is cached in `index_dir`, if given.
+
+    All files are parsed together by `n_workers` processes, see `plan_mbox_tasks`.
+    Of the copies of a message the earliest by Date is kept, and then the first one
+    by file path and position in the file, so the result does not depend on the order
+    the tasks complete in.
+    """
+    n_failed_to_parse = 0
+    messages = {}
+    is_selective = since is not None or until is not None or sample_rate is not None
+
+    mbox_files = sorted(Path(exports_dir).glob("**/*.mbox"))
+    file_ranks = {mbox_file: rank for rank, mbox_file in enumerate(mbox_files)}
+    mbox_files.sort(key=lambda mbox_file: mbox_file.stat().st_size, reverse=True)
+
+    mbox_entries = dict.fromkeys(mbox_files)
+    if is_selective:
+        # Files without cached index are indexed in byte ranges, like they are parsed
+        indexes = {
+            mbox_file: read_cached_mbox_index(mbox_file, index_dir)
+            for mbox_file in mbox_files
+        }
+        index_tasks = plan_mbox_tasks(
+            {mbox_file: None for mbox_file in mbox_files if indexes[mbox_file] is None},
+            chunk_size=chunk_size,
+        )
+        index_parts = collections.defaultdict(list)
+        with tqdm(
+            total=sum(task.size for task in index_tasks),
+            unit="B",
+            unit_scale=True,
+            desc="Indexing mbox",
+        ) as progress:
+            for task, entries in run_tasks(index_mbox_task, index_tasks, n_workers):
+                index_parts[task.mbox_file].extend(entries)
+                progress.update(task.size)
+
+        for mbox_file, entries in indexes.items():
+            if entries is None:
+                entries = sorted(index_parts[mbox_file])
+                save_mbox_index(mbox_file, entries, index_dir)
+            mbox_entries[mbox_file] = select_mbox_entries(
+                entries, since=since, until=until, sample_rate=sample_rate
+            )
+
+    tasks = plan_mbox_tasks(mbox_entries, chunk_size=chunk_size)
+
+    total_bytes = collections.Counter(dict.fromkeys(mbox_files, 0))
+    for task in tasks:
+        total_bytes[task.mbox_file] += task.size
+    done_bytes = collections.Counter()
+    message_positions = {}
+
+    with tqdm(
+        total=sum(total_bytes.values()),
+        unit="B",
+        unit_scale=True,
+        desc="Parsing mbox",
+    ) as progress:
+        for task, (parsed_messages, n_failed) in run_tasks(
+            parse_mbox_task, tasks, n_workers
+        ):
+            n_failed_to_parse += n_failed
+            for offset, message in parsed_messages:
+                if body_store is not None:
+                    message["body"] = body_store.put(
+                        {"text": message.pop("text"), "links": message.pop("links")}
+                    )
+
+                message_id = message["message_id"]
+                if message_id is not None:
+                    position = (
+                        message["unixtime"] is None,
+                        message["unixtime"] or 0,
+                        file_ranks[task.mbox_file],
+                        offset,
+                    )
                     # Duplicate: leave the earliest message
-                    previous_message = messages[message_id]
                     if (
-                        previous_message["unixtime"] is None
-                        or message["unixtime"] < previous_message["unixtime"]
+                        message_id not in messages
+                        or position < message_positions[message_id]
                     ):
                         messages[message_id] = message
-                else:
-                    messages[message_id] = message
+                        message_positions[message_id] = position
+
+            done_bytes[task.mbox_file] += task.size
+            progress.update(task.size)
+            progress.set_postfix_str(
+                _files_progress(done_bytes, total_bytes, exports_dir)
+            )
 
     print(f"Failed to parse: {n_failed_to_parse}")
-    return messages
+    return dict(
+        sorted(messages.items(), key=lambda item: message_positions[item[0]][2:])
+    )
 
 
 def read_alexa_ranks(
@@ -375,18 +697,47 @@ def read_alexa_ranks(
     return alexa_domain_rank
 
 
-def discover_and_parse_mbox(exports_dir="exports", cache_dir="cache"):
+def discover_and_parse_mbox(
+    exports_dir="exports", cache_dir="cache", since=None, until=None, sample_rate=None
+):
+    """
+    Detects accounts from the messages in `exports_dir`.
+
+    Parsed messages are cached in `cache_dir`: metadata in `email.json` and bodies
+    in the `bodies` store. Messages in `email.json` keep only `body` references instead of
+    `text` and `links`, use `get_message_body` with `BodyStore(Path(cache_dir) / "bodies")`
+    to read them.
+
+    `since`, `until` and `sample_rate` restrict the analysis to a part of the messages
+    for a quick look (see `select_mbox_entries`). Such partial results are not stored to
+    nor loaded from `email.json` and the `bodies` store, their bodies are kept in memory.
+    The detected addresses and accounts are written to `partial_my_email_addrs.json` and
+    `partial_accounts.json`, so the results of the full import are not replaced.
+    """
+    is_selective = since is not None or until is not None or sample_rate is not None
+    results_prefix = "partial_" if is_selective else ""
+
     messages_json = Path(cache_dir) / "email.json"
-    if messages_json.exists():
+    if messages_json.exists() and not is_selective:
         with open(messages_json, "r") as fin:
             messages = json.load(fin)
     else:
-        messages = parse_mbox(exports_dir)
+        body_store_path = None if is_selective else Path(cache_dir) / "bodies"
+        with BodyStore(body_store_path) as body_store:
+            messages = parse_mbox(
+                exports_dir,
+                body_store=body_store,
+                since=since,
+                until=until,
+                sample_rate=sample_rate,
+                index_dir=Path(cache_dir) / "mbox_index",
+            )
 
     label_threads(messages)
 
-    with open(messages_json, "w") as fout:
-        json.dump(messages, fout, ensure_ascii=False)
+    if not is_selective:
+        with open(messages_json, "w") as fout:
+            json.dump(messages, fout, ensure_ascii=False)
 
     my_addrs_list = find_my_addrs(messages)
     my_addrs = set([addr for addr, cnt in my_addrs_list])
@@ -394,7 +745,7 @@ def discover_and_parse_mbox(exports_dir="exports", cache_dir="cache"):
     print("My Email Addresses:")
     for addr, cnt in my_addrs_list:
         print(f"  - {addr} ({cnt} messages)")
-    with open(Path(cache_dir) / "my_email_addrs.json", "w") as fout:
+    with open(Path(cache_dir) / f"{results_prefix}my_email_addrs.json", "w") as fout:
         json.dump([addr for addr, cnt in my_addrs_list], fout)
 
     # Alexa rank. It is outdated, yet better than nothing.
@@ -403,7 +754,7 @@ def discover_and_parse_mbox(exports_dir="exports", cache_dir="cache"):
     threads = group_threads(messages)
     accounts = detect_accounts(threads, my_addrs, domain_rank=alexa_domain_rank)
 
-    with open(Path(cache_dir) / "accounts.json", "w") as fout:
+    with open(Path(cache_dir) / f"{results_prefix}accounts.json", "w") as fout:
         json.dump(accounts, fout)
 
     return accounts